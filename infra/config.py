@@ -21,6 +21,7 @@ class Config(object):
   ISOLATE_HOME_CONFIG = ('isolate', 'home', "ISOLATE_HOME")
   ISOLATE_SERVER_CONFIG = ('isolate', 'server', "ISOLATE_SERVER")
   ISOLATE_CACHE_DIR_CONFIG = ('isolate', 'cache_dir', "ISOLATE_CACHE_DIR")
+  FAST_ISOLATE_CONFIG = ('isolate', 'fast_client', "FAST_ISOLATE")
 
   # Beanstalk settings
   BEANSTALK_HOST_CONFIG = ('beanstalk', 'host', 'BEANSTALK_HOST')
@@ -31,6 +32,7 @@ class Config(object):
   DIST_TEST_USER_CONFIG = ('dist_test', 'user', 'DIST_TEST_USER')
   DIST_TEST_PASSWORD_CONFIG = ('dist_test', 'password', 'DIST_TEST_PASSWORD')
   DIST_TEST_URL_TIMEOUT_CONFIG = ('dist_test', 'url_timeout', 'DIST_TEST_URL_TIMEOUT')
+  ARTIFACT_ZIP_LEVEL_CONFIG = ('dist_test', 'artifact_zip_level', 'ARTIFACT_ZIP_LEVEL')
 
   def __init__(self, path=None):
     if path is None:
@@ -52,6 +54,10 @@ class Config(object):
     self.ISOLATE_HOME = self._get_with_env_override(*self.ISOLATE_HOME_CONFIG)
     self.ISOLATE_SERVER = self._get_with_env_override(*self.ISOLATE_SERVER_CONFIG)
     self.ISOLATE_CACHE_DIR = self._get_with_env_override(*self.ISOLATE_CACHE_DIR_CONFIG)
+    # Whether slaves should use the in-process isolate client rather than
+    # shelling out to isolateserver.py.
+    self.FAST_ISOLATE = \
+        str(self._get_with_env_override(*self.FAST_ISOLATE_CONFIG)).lower() in ("true", "1")
 
     # S3 settings
     self.AWS_ACCESS_KEY = self._get_with_env_override(*self.AWS_ACCESS_KEY_CONFIG)
@@ -83,6 +89,16 @@ class Config(object):
     self.DIST_TEST_URL_TIMEOUT = self._get_with_env_override(*self.DIST_TEST_URL_TIMEOUT_CONFIG)
     if self.DIST_TEST_URL_TIMEOUT  is not None:
       self.DIST_TEST_URL_TIMEOUT = float(self.DIST_TEST_URL_TIMEOUT)
+    # DEFLATE level for artifact archives. Archives are uploaded once and
+    # rarely downloaded, so we default to the fastest level rather than
+    # spending slave CPU on a marginally better ratio.
+    try:
+      self.ARTIFACT_ZIP_LEVEL = int(self._get_with_env_override(*self.ARTIFACT_ZIP_LEVEL_CONFIG))
+    except (TypeError, ValueError):
+      self.ARTIFACT_ZIP_LEVEL = 1
+    if not 0 <= self.ARTIFACT_ZIP_LEVEL <= 9:
+      raise Exception("Invalid artifact_zip_level %d: zlib compression "
+                      "levels run from 0 to 9." % self.ARTIFACT_ZIP_LEVEL)
 
     # dist_test master configs (in the 'dist_test' section)
     self.DIST_TEST_ALLOWED_IP_RANGES = self.config.get('dist_test', 'allowed_ip_ranges')
@@ -274,7 +274,7 @@ class ResultsStore(object):
 
     if artifact_archive:
       artifact_archive_key = "%s-artifacts.zip" % task.get_id()
-      self._upload_string_to_s3(artifact_archive_key, artifact_archive.getvalue())
+      self._upload_file_to_s3(artifact_archive_key, artifact_archive)
       logging.info("Uploaded artifact archive for %s to S3" % task.get_id())
 
     parms = dict(result_code=result_code,
@@ -374,6 +374,18 @@ class ResultsStore(object):
     k.set_metadata('Content-Disposition', str('inline; filename=%s' % key))
     k.set_contents_from_string(data, reduced_redundancy=True)
 
+  def _upload_file_to_s3(self, key, fp):
+    """Upload the contents of the file object 'fp' under 'key'.
+
+    The data is streamed from the (possibly disk-backed) file object
+    instead of being read into one large string first. 'fp' is rewound
+    here but remains open; closing it is the caller's responsibility."""
+    k = boto.s3.key.Key(self.s3_bucket)
+    k.key = key
+    # See _upload_string_to_s3 for the header handling.
+    k.set_metadata('Content-Disposition', str('inline; filename=%s' % key))
+    k.set_contents_from_file(fp, reduced_redundancy=True, rewind=True)
+
 def configure_logger(logger, filename):
   handlers = []
   handlers.append(logging.StreamHandler())
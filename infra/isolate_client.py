@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""In-process client for downloading isolated task dependencies.
+
+The stock 'isolateserver.py download' subprocess fetches files one at a
+time, so the download phase is dominated by per-request latency rather
+than bandwidth. This client parses the .isolated manifest itself and
+fetches the files with two bounded thread pools: many connections for
+small files (where round-trip latency dominates) and a few streaming
+connections for large ones (where bandwidth dominates).
+
+Fetched contents are stored in the slave's content cache keyed by hash,
+then hardlinked (or copied, across filesystems) into the target
+directory, matching the behavior of the subprocess client.
+"""
+
+import errno
+import logging
+import os
+import Queue
+import threading
+import zlib
+import json
+
+import requests
+
+import file_path
+
+LOG = logging.getLogger('dist_test.isolate_client')
+
+# Files below this size are fetched with the high-parallelism pool to
+# amortize request latency; larger files stream through a smaller pool
+# so a handful of big artifacts don't monopolize the connection limit.
+SMALL_FILE_THRESHOLD = 1024 * 1024
+SMALL_POOL_SIZE = 32
+LARGE_POOL_SIZE = 4
+
+# Chunk size for streaming large responses to disk.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class IsolateClient(object):
+
+  def __init__(self, isolate_server, cache_dir, namespace="default-gzip"):
+    self.server = isolate_server.rstrip("/")
+    self.cache_dir = cache_dir
+    self.namespace = namespace
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=SMALL_POOL_SIZE,
+                                            pool_maxsize=SMALL_POOL_SIZE)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+  def download(self, isolate_hash, target_dir):
+    """Download the dependency tree rooted at 'isolate_hash' into 'target_dir'.
+
+    Also writes the root manifest to 'task.isolated' in the target
+    directory and returns it parsed, mirroring what the slave expects
+    from the subprocess download path.
+    """
+    isolated_info = json.loads(self._fetch_to_cache(isolate_hash, read_back=True))
+    with open(os.path.join(target_dir, "task.isolated"), "wb") as f:
+      f.write(json.dumps(isolated_info))
+
+    files = {}
+    self._collect_files(isolated_info, files)
+
+    small = []
+    large = []
+    for relpath, meta in files.iteritems():
+      if meta.get("l") is not None:
+        # Symlinks carry no content; materialize them directly.
+        self._materialize_symlink(target_dir, relpath, meta["l"])
+        continue
+      if meta.get("s", 0) < SMALL_FILE_THRESHOLD:
+        small.append((relpath, meta))
+      else:
+        large.append((relpath, meta))
+
+    def fetch_one(item):
+      relpath, meta = item
+      cache_path = self._fetch_to_cache(meta["h"])
+      self._materialize_file(cache_path, target_dir, relpath, meta)
+
+    # Large files first so they overlap with the long tail of small ones.
+    # Join both pools before raising so no worker is still writing into
+    # target_dir when an error is reported and the caller retries.
+    large_pool = _WorkerPool(LARGE_POOL_SIZE, large, fetch_one)
+    small_pool = _WorkerPool(SMALL_POOL_SIZE, small, fetch_one)
+    errors = large_pool.join() + small_pool.join()
+    if errors:
+      raise errors[0]
+
+    return isolated_info
+
+  def _collect_files(self, isolated_info, files):
+    """Accumulate the 'files' maps of a manifest and its includes."""
+    for include_hash in isolated_info.get("includes", []):
+      included = json.loads(self._fetch_to_cache(include_hash, read_back=True))
+      self._collect_files(included, files)
+    files.update(isolated_info.get("files", {}))
+
+  def _fetch_to_cache(self, item_hash, read_back=False):
+    """Ensure the content for 'item_hash' is in the cache.
+
+    Returns the cache path, or the (decompressed) contents when
+    'read_back' is True."""
+    cache_path = os.path.join(self.cache_dir, item_hash)
+    if not os.path.exists(cache_path):
+      url = "%s/content-gs/retrieve/%s/%s" % (self.server, self.namespace, item_hash)
+      resp = self.session.get(url, stream=True, timeout=60)
+      resp.raise_for_status()
+      # Contents are zlib-compressed in the -gzip namespaces; stream the
+      # response through a decompressor so large files never have to fit
+      # in memory.
+      decompressor = None
+      if self.namespace.endswith("-gzip"):
+        decompressor = zlib.decompressobj()
+      tmp_path = cache_path + ".tmp.%d" % threading.current_thread().ident
+      try:
+        with open(tmp_path, "wb") as f:
+          for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+            if decompressor is not None:
+              chunk = decompressor.decompress(chunk)
+            f.write(chunk)
+          if decompressor is not None:
+            f.write(decompressor.flush())
+        os.rename(tmp_path, cache_path)
+      except:
+        try:
+          os.unlink(tmp_path)
+        except OSError:
+          pass
+        raise
+    if read_back:
+      with open(cache_path, "rb") as f:
+        return f.read()
+    return cache_path
+
+  def _materialize_file(self, cache_path, target_dir, relpath, meta):
+    dest = os.path.join(target_dir, relpath)
+    _makedirs_quiet(os.path.dirname(dest))
+    file_path.link_file(cache_path, dest)
+    mode = meta.get("m")
+    if mode is not None:
+      os.chmod(dest, mode)
+
+  def _materialize_symlink(self, target_dir, relpath, link_target):
+    dest = os.path.join(target_dir, relpath)
+    _makedirs_quiet(os.path.dirname(dest))
+    os.symlink(link_target, dest)
+
+
+class _WorkerPool(object):
+  """Runs a fixed number of threads over a list of work items."""
+
+  def __init__(self, num_threads, items, fn):
+    self.queue = Queue.Queue()
+    for item in items:
+      self.queue.put(item)
+    self.errors = []
+    self.threads = []
+    for _ in xrange(min(num_threads, len(items))):
+      t = threading.Thread(target=self._worker, args=(fn,))
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  def _worker(self, fn):
+    while True:
+      try:
+        item = self.queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        fn(item)
+      except Exception as e:
+        LOG.warning("Failed to fetch %s: %s", item, e, exc_info=True)
+        self.errors.append(e)
+
+  def join(self):
+    """Waits for all workers and returns the list of collected errors."""
+    for t in self.threads:
+      t.join()
+    return self.errors
+
+
+def _makedirs_quiet(path):
+  try:
+    os.makedirs(path)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
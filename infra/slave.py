@@ -1,35 +1,30 @@
 #!/usr/bin/env python
 
 from __future__ import with_statement
-import beanstalkc
-import boto
 import collections
-import cStringIO
 import errno
 import fcntl
-import glob2
+import fnmatch
+import json
 import logging
 import os
-import urllib
-import urllib2
+import Queue
 import re
+import requests
 import select
 import shutil
-import sys
-try:
-  import simplejson as json
-except:
-  import json
 import signal
 import subprocess
 import sys
+import tempfile
 import threading
 import time
-import zipfile
 
 from config import Config
 import dist_test
 import file_path
+import isolate_client
+import zip_util
 
 LOG = None
 
@@ -37,6 +32,20 @@ LOG = None
 # dependencies.
 NUM_DOWNLOAD_ATTEMPTS_PER_TASK = 3
 
+# Cap on how much child stdout/stderr is kept: a ring of 16 chunks of up
+# to 64KiB each (~1MiB) per stream. Only the tail is kept -- it's what
+# users look at when debugging a failure -- so memory stays constant no
+# matter how chatty the test is.
+OUTPUT_RING_CHUNKS = 16
+
+
+def _join_tail(chunks, total_bytes):
+  """Join a ring buffer of output chunks, marking any truncation."""
+  tail = "".join(chunks)
+  if total_bytes > len(tail):
+    tail = "[... %d bytes truncated ...]\n%s" % (total_bytes - len(tail), tail)
+  return tail
+
 class RetryCache(object):
   """Time-based and count-based cache to avoid running retried tasks
   again on the same slave. If a slave sees a retry it submitted, it
@@ -60,23 +69,68 @@ class RetryCache(object):
     self.max_count = max_count
 
   def get(self, item):
-    if not item in self.cache.keys():
+    count = self.cache.get(item)
+    if count is None:
       return None
-    count = self.cache[item]
     if count > self.max_count:
       LOG.debug("Item %s hit max_count of %d, evicting from cache", item, self.max_count)
       del self.cache[item]
     else:
-      self.cache[item] += 1
+      self.cache[item] = count + 1
 
     return item
 
   def put(self, item):
-    if len(self.cache.keys()) == self.max_size:
-      LOG.debug("Cache is at capacity %d, evicting oldest item %s", self.max_size, item)
-      self.cache.popitem()
+    if len(self.cache) >= self.max_size:
+      evicted, _ = self.cache.popitem(last=False)
+      LOG.debug("Cache is at capacity %d, evicted oldest item %s", self.max_size, evicted)
     self.cache[item] = 0
 
+class ArtifactGlob(object):
+  """A compiled artifact glob, matched against paths relative to the
+  test dir.
+
+  Matches glob2 semantics: each segment is translated individually with
+  fnmatch.translate, so character classes work but '*' and '?' never
+  cross a directory boundary, while '**' spans any number of them. Like
+  glob, wildcards do not match hidden files or directories unless the
+  pattern segment itself starts with a dot."""
+
+  def __init__(self, pattern):
+    self._segments = []
+    for seg in pattern.split("/"):
+      if seg == "**":
+        # Marker for "any number of segments".
+        self._segments.append(None)
+      else:
+        self._segments.append((re.compile(fnmatch.translate(seg)),
+                               seg.startswith(".")))
+
+  def match(self, relpath):
+    return self._match(self._segments, relpath.split("/"))
+
+  @classmethod
+  def _match(cls, pattern_segs, path_segs):
+    if not pattern_segs:
+      return not path_segs
+    head = pattern_segs[0]
+    if head is None:
+      # '**': consume zero or more segments, never hidden ones.
+      if cls._match(pattern_segs[1:], path_segs):
+        return True
+      return (len(path_segs) > 0 and
+              not path_segs[0].startswith(".") and
+              cls._match(pattern_segs, path_segs[1:]))
+    if not path_segs:
+      return False
+    seg_re, matches_hidden = head
+    if path_segs[0].startswith(".") and not matches_hidden:
+      return False
+    if not seg_re.match(path_segs[0]):
+      return False
+    return cls._match(pattern_segs[1:], path_segs[1:])
+
+
 class Slave(object):
 
   def __init__(self, config):
@@ -86,16 +140,49 @@ class Slave(object):
     self.task_queue = dist_test.TaskQueue(self.config)
     self.results_store = dist_test.ResultsStore(self.config)
     self.cache_dir = self._get_exclusive_cache_dir()
+    self.isolate_client = None
+    if self.config.FAST_ISOLATE:
+      self.isolate_client = isolate_client.IsolateClient(
+          self.config.ISOLATE_SERVER, self.cache_dir)
     self.cur_task = None
     self.is_busy = False
     self.retry_cache = RetryCache()
+    # One HTTP session for all master calls: keep-alive avoids a fresh
+    # TCP (and TLS) handshake per request, and the adapter retries
+    # transient failures with a short backoff.
+    self._http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=4,
+        max_retries=requests.packages.urllib3.util.retry.Retry(
+            total=3, backoff_factor=0.2))
+    self._http.mount("http://", adapter)
+    self._http.mount("https://", adapter)
+    if self.config.DIST_TEST_USER:
+      self._http.auth = requests.auth.HTTPDigestAuth(
+          self.config.DIST_TEST_USER, self.config.DIST_TEST_PASSWORD)
+    # Trashed test directories are deleted off the critical path by a
+    # daemon thread, so it dies with the process on shutdown.
+    self._gc_queue = Queue.Queue()
+    gc_thread = threading.Thread(target=self._gc_worker)
+    gc_thread.daemon = True
+    gc_thread.start()
+    # Retry submissions are posted to the master from a background
+    # thread, so a failed task doesn't block the slave from reserving
+    # its next task while the master responds. Daemon: an unposted retry
+    # on shutdown is recovered by the job's normal failure handling.
+    self._retry_queue = Queue.Queue()
+    retry_thread = threading.Thread(target=self._retry_worker)
+    retry_thread.daemon = True
+    retry_thread.start()
 
   def _get_exclusive_cache_dir(self):
     for i in xrange(0, 16):
       dir = "%s.%d" % (self.config.ISOLATE_CACHE_DIR, i)
       if not os.path.isdir(dir):
         os.makedirs(dir)
-      self._lockfile = file(dir + ".lock", "w")
+      # The lock file is only used for fcntl.lockf on its fd; the
+      # contents don't matter.
+      self._lockfile = open(dir + ".lock", "wb")
       try:
         fcntl.lockf(self._lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
       except IOError, e:
@@ -110,11 +197,37 @@ class Slave(object):
     raise Exception("Unable to lock any cache dir %s.<int>" %
         self.config.ISOLATE_CACHE_DIR)
 
+  def _gc_worker(self):
+    """Deletes trashed test directories queued by run_task."""
+    while True:
+      path = self._gc_queue.get()
+      LOG.info("Removing trashed test directory %s", path)
+      shutil.rmtree(path, ignore_errors=True)
+
+  def _retry_worker(self):
+    """Posts queued retry submissions to the master."""
+    while True:
+      task = self._retry_queue.get()
+      try:
+        self.submit_retry_task(task)
+      except Exception:
+        LOG.warning("Failed to submit retry task", exc_info=True)
+
   def _set_flags(self, f):
     fd = f.fileno()
     fl = fcntl.fcntl(fd, fcntl.F_GETFL)
     fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
+  @staticmethod
+  def _signal_task_group(p, sig):
+    """Signal the child's whole process group, so grandchildren spawned
+    by the test don't outlive it."""
+    try:
+      os.killpg(os.getpgid(p.pid), sig)
+    except OSError:
+      # The child may already have exited.
+      pass
+
   def make_archive(self, task, test_dir):
     # Return early if no test_dir is specified
     if test_dir is None:
@@ -122,52 +235,93 @@ class Slave(object):
     # Return early if there are no globs specified
     if task.task.artifact_archive_globs is None or len(task.task.artifact_archive_globs) == 0:
       return None
-    all_matched = set()
-    total_size = 0
+    matchers = []
     for g in task.task.artifact_archive_globs:
       try:
-          matched = glob2.iglob(test_dir + "/" + g)
-          for m in matched:
-            canonical = os.path.realpath(m)
-            if not canonical.startswith(test_dir):
-              LOG.warn("Glob %s matched file outside of test_dir, skipping: %s" % (g, canonical))
-              continue
-            total_size += os.stat(canonical).st_size
-            all_matched.add(canonical)
+        matchers.append(ArtifactGlob(g))
       except Exception as e:
-        LOG.warn("Error while globbing %s: %s" % (g, e))
+        LOG.warn("Error compiling artifact glob %s: %s" % (g, e))
+    if len(matchers) == 0:
+      return None
+
+    # Walk the test dir once and match every file against all of the
+    # compiled globs, rather than re-traversing the tree per glob.
+    # Canonicalization is the expensive part of the symlink-escape check
+    # (realpath does a readlink per path component), so resolve test_dir
+    # once and cache the resolved parent per directory; only files that
+    # are themselves symlinks need a full realpath.
+    test_dir_real = os.path.realpath(test_dir)
+    realpath_cache = {}
+    all_matched = set()
+    for dirpath, dirnames, filenames in os.walk(test_dir):
+      for fname in filenames:
+        full = os.path.join(dirpath, fname)
+        rel = os.path.relpath(full, test_dir)
+        if not any(m.match(rel) for m in matchers):
+          continue
+        if os.path.islink(full):
+          canonical = os.path.realpath(full)
+        else:
+          parent = realpath_cache.get(dirpath)
+          if parent is None:
+            parent = os.path.realpath(dirpath)
+            realpath_cache[dirpath] = parent
+          canonical = os.path.join(parent, fname)
+        if not canonical.startswith(test_dir_real):
+          LOG.warn("Glob matched file outside of test_dir, skipping: %s" % canonical)
+          continue
+        all_matched.add(canonical)
 
     if len(all_matched) == 0:
       return None
+
+    # Write out the archive. Entries are streamed through the writer in
+    # chunks, so we never hold more than a chunk of any artifact in memory.
+    # Sizes are taken from the fstat of each opened file as it is written,
+    # so no separate stat pass over the matches is needed.
     max_size = 200*1024*1024 # 200MB max uncompressed size
-    if total_size > max_size:
-      # If size exceeds the maximum size, upload a zip with an error message instead
-      LOG.info("Task %s generated too many bytes of matched artifacts (%d > %d)," \
-               + "uploading archive with error message instead.",
-              task.task.get_id(), total_size, max_size)
-      archive_buffer = cStringIO.StringIO()
-      with zipfile.ZipFile(archive_buffer, "w") as myzip:
+    archive_buffer = self._new_archive_buffer()
+    myzip = zip_util.ZipWriter(archive_buffer, level=self.config.ARTIFACT_ZIP_LEVEL)
+    total_size = 0
+    for m in all_matched:
+      arcname = os.path.relpath(m, test_dir_real)
+      while arcname.startswith("/"):
+        arcname = arcname[1:]
+      total_size += myzip.write_file(m, arcname)
+      if total_size > max_size:
+        # If size exceeds the maximum size, upload a zip with an error message instead
+        LOG.info("Task %s generated too many bytes of matched artifacts (%d > %d)," \
+                 + "uploading archive with error message instead.",
+                task.task.get_id(), total_size, max_size)
+        archive_buffer.close()
+        archive_buffer = self._new_archive_buffer()
+        myzip = zip_util.ZipWriter(archive_buffer, level=self.config.ARTIFACT_ZIP_LEVEL)
         myzip.writestr("_ARCHIVE_TOO_BIG_",
                        "Size of matched uncompressed test artifacts exceeded maximum size" \
                        + "(%d bytes > %d bytes)!" % (total_size, max_size))
-      return archive_buffer
-
-    # Write out the archive
-    archive_buffer = cStringIO.StringIO()
-    with zipfile.ZipFile(archive_buffer, "w", zipfile.ZIP_DEFLATED) as myzip:
-      for m in all_matched:
-        arcname = os.path.relpath(m, test_dir)
-        while arcname.startswith("/"):
-          arcname = arcname[1:]
-        myzip.write(m, arcname)
+        myzip.close()
+        return archive_buffer
+    myzip.close()
+    LOG.info("Task %s artifact archive: %d bytes uncompressed, %d bytes compressed (level %d)",
+             task.task.get_id(), total_size, archive_buffer.tell(),
+             self.config.ARTIFACT_ZIP_LEVEL)
 
     return archive_buffer
 
+  @staticmethod
+  def _new_archive_buffer():
+    # Small archives stay in memory; anything bigger spools to disk so
+    # peak RSS no longer scales with the size of the artifact set.
+    return tempfile.SpooledTemporaryFile(max_size=8*1024*1024)
+
   def download_task_files(self, task, test_dir):
     """
     Download all of the files associated with 'task' into 'test_dir'.
     The directory is expected to already exist.
     """
+    if self.isolate_client is not None:
+      return self._download_task_files_inprocess(task, test_dir)
+
     env = os.environ.copy()
     # Make isolateserver run in 'bot' mode. This prevents it from trying
     # to use oauth to authenticate.
@@ -202,7 +356,28 @@ class Slave(object):
     # We expect to have all of the files that we download writable, but
     # 'isolateserver.py download' defaults to not writable.
     file_path.make_tree_writeable(test_dir)
-    return json.load(file(isolated_path))
+    with open(isolated_path, "rb") as f:
+      return json.load(f)
+
+  def _download_task_files_inprocess(self, task, test_dir):
+    """Download task files via the in-process isolate client.
+
+    There is no child process loop to touch the task from, so the
+    touches are driven by the same 10s timer thread used while running
+    the command, keeping the task alive even if a single large fetch
+    takes longer than the beanstalk TTR."""
+    LOG.info("Downloading files from isolate (in-process client)...")
+    stop_touching = threading.Event()
+    toucher = threading.Thread(target=self._touch_loop, args=(task, stop_touching))
+    toucher.daemon = True
+    toucher.start()
+    try:
+      isolated_info = self.isolate_client.download(task.task.isolate_hash, test_dir)
+    finally:
+      stop_touching.set()
+      toucher.join()
+    file_path.make_tree_writeable(test_dir)
+    return isolated_info
 
   def download_task_files_with_retries(self, task, test_dir):
     """ Calls download_task_files(...) with automatic retries on failure """
@@ -289,10 +464,20 @@ class Slave(object):
                                           artifact_archive=artifact_archive,
                                           duration_secs=duration_secs)
 
-    # Do cleanup of temp files
+    # Do cleanup of temp files. Deleting tens of thousands of downloaded
+    # files can take several seconds of the slave's time between tasks,
+    # so rename the directory aside (a sibling rename, so it stays on the
+    # same filesystem) and let the gc thread delete it while the slave
+    # reserves the next task.
     if test_dir is not None:
-      LOG.info("Removing test directory %s" % test_dir)
-      shutil.rmtree(test_dir)
+      trash_dir = test_dir + ".trash"
+      LOG.info("Trashing test directory %s" % test_dir)
+      try:
+        os.rename(test_dir, trash_dir)
+        self._gc_queue.put(trash_dir)
+      except OSError:
+        LOG.warning("Could not trash test directory, removing inline", exc_info=True)
+        shutil.rmtree(test_dir, ignore_errors=True)
     if artifact_archive is not None:
       artifact_archive.close()
 
@@ -304,7 +489,11 @@ class Slave(object):
         self.cancel_job(task.task.job_id)
       # Retry if non-zero exit code and have retries remaining
       elif task.task.attempt < task.task.max_retries:
-        self.submit_retry_task(task)
+        # Record the anti-affinity entry here, synchronously, so it is
+        # in place before the retry can possibly come back to us; the
+        # HTTP post itself happens on the retry thread.
+        self.retry_cache.put(task.task.get_retry_id())
+        self._retry_queue.put(task)
 
 
   def run_command_and_touch_task(self, cmd, task, timeout, **kwargs):
@@ -324,54 +513,146 @@ class Slave(object):
         The timeout with which to run the given command.
     """
     LOG.info("Running command: %s", repr(cmd))
+    # Run the child in its own session so timeouts can signal the whole
+    # process group, and don't leak the slave's fds (beanstalk/MySQL
+    # sockets, cache dir lock) into test processes.
     p = subprocess.Popen(
-      cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
-    pipes = [p.stdout, p.stderr]
+      cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+      close_fds=True, preexec_fn=os.setsid, **kwargs)
     self._set_flags(p.stdout)
     self._set_flags(p.stderr)
-
-    stdout = ""
-    stderr = ""
-
-    last_touch = time.time()
-    kill_term_time = last_touch + timeout
+    out_fd = p.stdout.fileno()
+    err_fd = p.stderr.fileno()
+    # Register the pipes once instead of rebuilding fd sets for every
+    # select() call.
+    poller = select.poll()
+    for fd in (out_fd, err_fd):
+      poller.register(fd, select.POLLIN)
+
+    # Accumulate output in bounded rings of chunks and join once at the
+    # end; repeated += on the full buffer is O(N^2) for chatty children,
+    # and anything beyond the tail is never uploaded anyway.
+    stdout_chunks = collections.deque(maxlen=OUTPUT_RING_CHUNKS)
+    stderr_chunks = collections.deque(maxlen=OUTPUT_RING_CHUNKS)
+    chunks_by_fd = {out_fd: stdout_chunks, err_fd: stderr_chunks}
+    bytes_read = {out_fd: 0, err_fd: 0}
+
+    # Touch the task from a dedicated thread rather than inside the
+    # output loop: it keeps the hot loop simpler and the touches keep
+    # happening even if this thread stalls for more than the beanstalk
+    # TTR (e.g. blocked writing the kill message while the box is
+    # swapping).
+    stop_touching = threading.Event()
+    toucher = threading.Thread(target=self._touch_loop, args=(task, stop_touching))
+    toucher.daemon = True
+    toucher.start()
+
+    # The clock is read once per loop iteration into 'now' and reused by
+    # the deadline computation and the kill checks below.
+    now = time.time()
+    kill_term_time = now + timeout
     kill_kill_time = kill_term_time + 5
-    while True:
-      rlist, wlist, xlist = select.select(pipes, [], pipes, 2)
-      if p.stdout in rlist:
-        x = p.stdout.read(1024 * 1024)
-        stdout += x
-      if p.stderr in rlist:
-        x = p.stderr.read(1024 * 1024)
-        stderr += x
-      if xlist or p.poll() is not None:
-        break
-      now = time.time()
-      if timeout > 0 and now > kill_term_time:
-        LOG.info("Task timed out: " + task.task.description)
-        stderr += "\n------\nKilling task after %d seconds" % timeout
-        p.terminate()
-      if timeout > 0 and now > kill_kill_time:
-        LOG.info("Task did not exit after SIGTERM. Sending SIGKILL")
-        p.kill()
-
-      if time.time() - last_touch > 10:
-        LOG.info("Still running: " + task.task.description)
+    sigterm_sent = False
+    sigkill_sent = False
+    try:
+      while True:
+        # Wake when the next kill action is due rather than on a fixed 2
+        # second tick (capped at 2s so the child's exit is still noticed
+        # promptly).
+        if timeout > 0 and now <= kill_kill_time:
+          if now <= kill_term_time:
+            next_deadline = kill_term_time
+          else:
+            next_deadline = kill_kill_time
+          poll_timeout_ms = int(max(0, min(2, next_deadline - now)) * 1000)
+        else:
+          # No timeout, or both kill deadlines have already passed and
+          # we're just waiting for the child to be reaped; tick slowly
+          # rather than spinning on a zero timeout.
+          poll_timeout_ms = 2000
+
+        for fd, event in poller.poll(poll_timeout_ms):
+          if event & (select.POLLIN | select.POLLHUP):
+            # Read straight from the fd with a single read(2) rather than
+            # going through the buffered file object; 64KiB matches the
+            # default Linux pipe capacity.
+            try:
+              chunk = os.read(fd, 65536)
+            except OSError as e:
+              if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                continue
+              raise
+            if chunk:
+              chunks_by_fd[fd].append(chunk)
+              bytes_read[fd] += len(chunk)
+            else:
+              # EOF. Stop polling this pipe; the loop keeps running on
+              # the poll timeout so the kill logic still fires even if
+              # the child closed its outputs but hasn't exited.
+              poller.unregister(fd)
+          elif event & (select.POLLERR | select.POLLNVAL):
+            poller.unregister(fd)
+        if p.poll() is not None:
+          break
+        now = time.time()
+        if timeout > 0 and now > kill_term_time and not sigterm_sent:
+          sigterm_sent = True
+          LOG.info("Task timed out: " + task.task.description)
+          # Appended (and counted) once: repeated appends would push real
+          # output chunks out of the bounded ring.
+          marker = "\n------\nKilling task after %d seconds" % timeout
+          stderr_chunks.append(marker)
+          bytes_read[err_fd] += len(marker)
+          self._signal_task_group(p, signal.SIGTERM)
+        if timeout > 0 and now > kill_kill_time and not sigkill_sent:
+          sigkill_sent = True
+          LOG.info("Task did not exit after SIGTERM. Sending SIGKILL")
+          self._signal_task_group(p, signal.SIGKILL)
+    finally:
+      stop_touching.set()
+      # Join so no touch is still in flight when the caller goes on to
+      # delete/release the element on the same (non-thread-safe)
+      # beanstalkc connection. The event wakes the thread's wait(10)
+      # immediately, so this only blocks for an in-progress touch.
+      toucher.join()
+
+    # Drain anything left in the pipes after the child exited.
+    for fd, chunks in chunks_by_fd.items():
+      while True:
         try:
-          task.bs_elem.touch()
-        except:
-          LOG.info("Could not touch beanstalk queue elem", exc_info=True)
-          pass
-        last_touch = time.time()
-
-    return p.wait(), stdout, stderr
+          chunk = os.read(fd, 65536)
+        except OSError:
+          break
+        if not chunk:
+          break
+        chunks.append(chunk)
+        bytes_read[fd] += len(chunk)
+
+    rc = p.wait()
+    LOG.info("Child produced %d bytes of stdout, %d bytes of stderr",
+             bytes_read[out_fd], bytes_read[err_fd])
+    if rc == 0:
+      # Output of successful commands is discarded by the callers; skip
+      # the join entirely.
+      return rc, "", ""
+    return (rc,
+            _join_tail(stdout_chunks, bytes_read[out_fd]),
+            _join_tail(stderr_chunks, bytes_read[err_fd]))
+
+  def _touch_loop(self, task, stop_evt):
+    """Touches 'task' in beanstalk every 10s until 'stop_evt' is set."""
+    while not stop_evt.wait(10):
+      LOG.info("Still running: " + task.task.description)
+      try:
+        task.bs_elem.touch()
+      except:
+        LOG.info("Could not touch beanstalk queue elem", exc_info=True)
 
   def cancel_job(self, job_id):
     url = self.config.DIST_TEST_MASTER + "/cancel_job?job_id=" + job_id
     LOG.info("Cancelling job %s via url %s" % (job_id, url))
     try:
-        result_str = urllib2.urlopen(url).read()
-        result = json.loads(result_str)
+        result = self._http.get(url, timeout=10).json()
         if result.get('status') != 'SUCCESS':
             sys.stderr.write("Unable to cancel job %s: %s" % (job_id, repr(result)))
     except Exception as e:
@@ -379,14 +660,10 @@ class Slave(object):
 
   def submit_retry_task(self, task):
     task_json = task.task.to_json()
-    form_data = urllib.urlencode({'task_json': task_json})
     url = self.config.DIST_TEST_MASTER + "/retry_task"
-    result_str = urllib2.urlopen(url, data=form_data).read()
-    result = json.loads(result_str)
+    result = self._http.post(url, data={'task_json': task_json}, timeout=10).json()
     if result.get('status') != 'SUCCESS':
       sys.stderr.write("Unable to submit retry task: %s\n" % repr(result))
-    # Add to the retry cache for anti-affinity
-    self.retry_cache.put(task.task.get_retry_id())
 
   def handle_sigterm(self):
     logging.error("caught SIGTERM! shutting down")
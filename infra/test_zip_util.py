@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import zip_util
+
+class TestZipWriter(unittest.TestCase):
+
+    def test_round_trip(self):
+        src_dir = tempfile.mkdtemp()
+        try:
+            contents = {
+                "small.txt": "hello world\n",
+                # Larger than the writer's chunk size, so the CRC and
+                # compressor run over multiple chunks.
+                "sub/large.bin": os.urandom(3 * 1024 * 1024),
+            }
+            for name, data in contents.items():
+                path = os.path.join(src_dir, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, "wb") as f:
+                    f.write(data)
+
+            buf = tempfile.TemporaryFile()
+            writer = zip_util.ZipWriter(buf, level=1)
+            for name in sorted(contents):
+                usize = writer.write_file(os.path.join(src_dir, name), name)
+                self.assertEqual(usize, len(contents[name]))
+            writer.writestr("note.txt", "stored from string")
+            writer.close()
+
+            buf.seek(0)
+            myzip = zipfile.ZipFile(buf)
+            # testzip() re-reads every member and verifies its CRC.
+            self.assertIsNone(myzip.testzip())
+            for name, data in contents.items():
+                self.assertEqual(myzip.read(name), data)
+            self.assertEqual(myzip.read("note.txt"), "stored from string")
+        finally:
+            shutil.rmtree(src_dir)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import os
+import struct
+import time
+import zlib
+
+# Chunk size used when streaming file contents into the archive. Each
+# entry is compressed incrementally, so this bounds the per-entry
+# working set regardless of how large the matched artifacts are.
+CHUNK_SIZE = 1024 * 1024
+
+# ZIP format constants. We only ever write deflated entries.
+ZIP_VERSION_NEEDED = 20
+ZIP_METHOD_DEFLATED = 8
+LOCAL_HEADER_SIG = 0x04034b50
+CENTRAL_DIR_SIG = 0x02014b50
+END_OF_CENTRAL_DIR_SIG = 0x06054b50
+
+
+def _dos_time(timestamp):
+  """Convert a unix timestamp to (dos_date, dos_time) for ZIP headers."""
+  t = time.localtime(timestamp)
+  dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+  dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+  return dos_date, dos_time
+
+
+class ZipWriter(object):
+  """Minimal streaming ZIP writer.
+
+  Unlike zipfile.ZipFile, this streams each entry through a zlib
+  compressor in fixed-size chunks rather than slurping whole files into
+  memory, so peak memory usage is bounded by CHUNK_SIZE rather than the
+  size of the largest artifact. The produced DEFLATE bitstream is
+  identical to what zipfile would emit at the same level.
+
+  The writer does not own the underlying file object: close() finalizes
+  the central directory but leaves the file open so the caller can seek
+  back and upload it."""
+
+  def __init__(self, fileobj, level=6):
+    self.fp = fileobj
+    self.level = level
+    # List of per-entry central directory records, built as entries are
+    # written and emitted on close().
+    self._entries = []
+    self._closed = False
+
+  def write_file(self, path, arcname):
+    """Stream the file at 'path' into the archive as 'arcname'.
+
+    Returns the uncompressed size of the file."""
+    with open(path, "rb") as src:
+      st = os.fstat(src.fileno())
+      return self._write_entry(arcname, self._iter_chunks(src), st.st_mtime)
+
+  def writestr(self, arcname, data):
+    """Write the string 'data' into the archive as 'arcname'."""
+    return self._write_entry(arcname, [data], time.time())
+
+  def close(self):
+    """Write the central directory. Does not close the underlying file."""
+    if self._closed:
+      return
+    self._closed = True
+    cd_offset = self.fp.tell()
+    for e in self._entries:
+      self.fp.write(struct.pack(
+          "<IHHHHHHIIIHHHHHII",
+          CENTRAL_DIR_SIG,
+          ZIP_VERSION_NEEDED,       # version made by
+          ZIP_VERSION_NEEDED,       # version needed to extract
+          0,                        # flags
+          ZIP_METHOD_DEFLATED,
+          e['dos_time'], e['dos_date'],
+          e['crc'], e['csize'], e['usize'],
+          len(e['name']),
+          0, 0, 0, 0,               # extra/comment len, disk, internal attrs
+          0644 << 16,               # external attrs: regular file mode
+          e['offset']))
+      self.fp.write(e['name'])
+    cd_size = self.fp.tell() - cd_offset
+    count = len(self._entries)
+    self.fp.write(struct.pack(
+        "<IHHHHIIH",
+        END_OF_CENTRAL_DIR_SIG,
+        0, 0,                       # disk numbers
+        count, count,
+        cd_size, cd_offset,
+        0))                         # comment length
+
+  @staticmethod
+  def _iter_chunks(src):
+    while True:
+      chunk = src.read(CHUNK_SIZE)
+      if not chunk:
+        return
+      yield chunk
+
+  def _write_entry(self, arcname, chunks, mtime):
+    if isinstance(arcname, unicode):
+      arcname = arcname.encode("utf-8")
+    dos_date, dos_time = _dos_time(mtime)
+    header_offset = self.fp.tell()
+    # Write the local header with placeholder CRC/sizes; the underlying
+    # spool file is seekable, so we patch them in after compressing
+    # rather than emitting a data descriptor.
+    self.fp.write(struct.pack(
+        "<IHHHHHIIIHH",
+        LOCAL_HEADER_SIG,
+        ZIP_VERSION_NEEDED,
+        0,                          # flags
+        ZIP_METHOD_DEFLATED,
+        dos_time, dos_date,
+        0, 0, 0,                    # crc, csize, usize (patched below)
+        len(arcname),
+        0))                         # extra field length
+    self.fp.write(arcname)
+
+    crc = 0
+    usize = 0
+    csize = 0
+    compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+    for chunk in chunks:
+      crc = zlib.crc32(chunk, crc) & 0xffffffff
+      usize += len(chunk)
+      compressed = compressor.compress(chunk)
+      if compressed:
+        csize += len(compressed)
+        self.fp.write(compressed)
+    compressed = compressor.flush()
+    if compressed:
+      csize += len(compressed)
+      self.fp.write(compressed)
+
+    # Patch the real CRC and sizes into the local header.
+    end_offset = self.fp.tell()
+    self.fp.seek(header_offset + 14)
+    self.fp.write(struct.pack("<III", crc, csize, usize))
+    self.fp.seek(end_offset)
+
+    self._entries.append(dict(name=arcname,
+                              dos_date=dos_date,
+                              dos_time=dos_time,
+                              crc=crc,
+                              csize=csize,
+                              usize=usize,
+                              offset=header_offset))
+    return usize